@@ -1,8 +1,8 @@
+import hashlib
 import os
 import random
 from datetime import datetime
 import numpy as np
-from scipy.signal import savgol_filter
 import torch
 from torch import nn
 from torch.utils.data.dataset import Dataset
@@ -31,28 +31,85 @@ class Data(Dataset):
             inputSpeechPath = validationAudioPath
         else:
             inputSpeechPath = os.path.join(ROOT_PATH, 'data', 'samSoar', 'samSoar.wav')
-        waveform, sampleRate = torchaudio.load(inputSpeechPath)
-        if sampleRate != 16000:
-            waveform = torchaudio.transforms.Resample(sampleRate, 16000)(waveform)
-            sampleRate = 16000
-
-        self.count = int(animFPS * (waveform.size()[1] / sampleRate))
-
-        # remove DC component
-        waveform -= torch.mean(waveform)
-
-        self.MFCC = torchaudio.compliance.kaldi.mfcc(
-            waveform,
-            channel=0,
-            remove_dc_offset=True,
-            window_type='hanning',
-            num_ceps=32,
-            num_mel_bins=64,
-            frame_length=256,
-            frame_shift=32
+
+        maskDir = os.path.join(ROOT_PATH, 'data', 'samSoar', 'maskSeq')
+        cacheState = '{}:{}:ceps32mel64len256shift32'.format(
+            inputSpeechPath, os.path.getmtime(inputSpeechPath)
         )
+        if not self.preview:
+            # the cache also holds the mask targets, so regenerated masks
+            # must invalidate it
+            maskPaths = [
+                os.path.join(maskDir, name)
+                for name in os.listdir(maskDir) if name.endswith('.npy')
+            ]
+            cacheState += ':{}:{}'.format(
+                len(maskPaths), max(map(os.path.getmtime, maskPaths))
+            )
+        cacheKey = hashlib.sha1(cacheState.encode()).hexdigest()
+        cachePath = os.path.join(ROOT_PATH, 'cache', '{}.pt'.format(cacheKey))
+
+        cached = None
+        if os.path.exists(cachePath):
+            # mmap keeps the cache pages shared across DataLoader workers
+            cached = torch.load(cachePath, map_location='cpu', mmap=True)
+            if not self.preview and 'masks' not in cached:
+                cached = None  # written by a preview run, recompute with masks
+
+        if cached is not None:
+            self.count = cached['count']
+            self.MFCC = cached['mfcc']
+            if not self.preview:
+                self.masks = cached['masks']
+        else:
+            waveform, sampleRate = torchaudio.load(inputSpeechPath)
+            if sampleRate != 16000:
+                waveform = torchaudio.transforms.Resample(sampleRate, 16000)(waveform)
+                sampleRate = 16000
+
+            self.count = int(animFPS * (waveform.size()[1] / sampleRate))
+
+            self.MFCC = torchaudio.compliance.kaldi.mfcc(
+                waveform,
+                channel=0,
+                remove_dc_offset=True,
+                window_type='hanning',
+                num_ceps=32,
+                num_mel_bins=64,
+                frame_length=256,
+                frame_shift=32
+            )
+
+            cached = {'count': self.count, 'mfcc': self.MFCC}
+            if not self.preview:
+                self.masks = torch.from_numpy(np.stack([
+                    np.load(
+                        os.path.join(maskDir, 'mask.{:05d}.npy'.format(k + 1))
+                    )
+                    for k in range(self.count)
+                ])).float().view(-1, OUTPUT_COUNT)
+                self.masks *= .5  # output values are assumed to have max of 2 and min of -2
+                self.masks.share_memory_()  # one copy across all DataLoader workers
+                cached['masks'] = self.masks
+
+            if not os.path.exists(os.path.dirname(cachePath)):
+                os.makedirs(os.path.dirname(cachePath))
+            torch.save(cached, cachePath)
+
         self.MFCCLen = self.MFCC.size()[0]
 
+        # pad 32 frames of silence on both ends so every sample is one
+        # contiguous slice, no boundary handling needed in __getitem__
+        self.padded = nn.functional.pad(self.MFCC, (0, 0, 32, 32))
+        idx = torch.from_numpy(
+            (np.arange(self.count + 1) * (self.MFCCLen / self.count)).astype(np.int64)
+        )
+        # one row of padded-frame indices per animation frame
+        self.gather = idx.unsqueeze(1) + torch.arange(64)
+
+        if self.preview:
+            self.zeroTarget = torch.zeros(1, OUTPUT_COUNT)
+
     def __getitem__(self, i):
         if i < 0:  # for negative indexing
             i = self.count + i
@@ -61,92 +118,17 @@ class Data(Dataset):
             randomShift = random.randint(0, 1)  # frame length 64 is about 8 ms
         else:
             randomShift = 0
-        audioIdxRoll = int(i * (self.MFCCLen / self.count) + randomShift)
-        audioIdxRollPair = int((i + 1) * (self.MFCCLen / self.count) + randomShift)
-        if audioIdxRoll < 32 or audioIdxRollPair < 32 or audioIdxRoll + 32 > self.MFCCLen or audioIdxRollPair + 32 > self.MFCCLen:
-            inputValue = (
-                torch.cat(
-                    (
-                        torch.cat(
-                            (
-                                torch.roll(
-                                    self.MFCC,
-                                    (audioIdxRoll * -1) + 32,
-                                    dims=0,
-                                )[:32],
-                                torch.roll(
-                                    self.MFCC,
-                                    (audioIdxRoll * -1),
-                                    dims=0,
-                                )[:32],
-                            ),
-                            dim=0,
-                        ),
-                        torch.cat(
-                            (
-                                torch.roll(
-                                    self.MFCC,
-                                    (audioIdxRollPair * -1) + 32,
-                                    dims=0,
-                                )[:32],
-                                torch.roll(
-                                    self.MFCC,
-                                    (audioIdxRollPair * -1),
-                                    dims=0,
-                                )[:32],
-                            ),
-                            dim=0,
-                        ),
-                    ),
-                    dim=0,
-                )
-                .view(2, 1, 64, 32)
-                .float()
-
-            )
-        else:
-            inputValue = (
-                torch.cat(
-                    (
-                        self.MFCC[audioIdxRoll - 32: audioIdxRoll + 32],
-                        self.MFCC[audioIdxRollPair - 32: audioIdxRollPair + 32]
-                    ),
-                    dim=0,
-                )
-                .view(2, 1, 64, 32)
-                .float()
-
+        inputValue = torch.stack(
+            (
+                self.padded.index_select(0, self.gather[i] + randomShift),
+                self.padded.index_select(0, self.gather[i + 1] + randomShift),
             )
+        ).unsqueeze(1)
 
         if self.preview:
-            return (
-                torch.Tensor([i]).long(),
-                inputValue[0],
-                torch.zeros((1, OUTPUT_COUNT))
-            )
-
-        targetValue = torch.from_numpy(np.append(
-            np.load(
-                os.path.join(
-                    ROOT_PATH,
-                    'data', 'samSoar', 'maskSeq',
-                    'mask.{:05d}.npy'.format(i + 1)
-                )
-            ),
-            np.load(
-                os.path.join(
-                    ROOT_PATH,
-                    'data', 'samSoar', 'maskSeq',
-                    'mask.{:05d}.npy'.format(i + 2)
-                )
-            )
-        )).float().view(-1, OUTPUT_COUNT)
+            return i, inputValue[0], self.zeroTarget
 
-        return (
-            torch.Tensor([i]).long(),
-            inputValue,
-            (targetValue) * .5  # output values are assumed to have max of 2 and min of -2
-        )
+        return i, inputValue, self.masks[i: i + 2]
 
     def __len__(self):
         if self.preview:
@@ -176,13 +158,17 @@ class Model(nn.Module):
         )
 
         self.moodLen = 16
-        mood = np.random.normal(.0, 1., (moodSize, self.moodLen))
+        mood = torch.randn(moodSize, self.moodLen, device=DEVICE)
         if filterMood:
-            mood = savgol_filter(mood, 129, 2, axis=0)
-        self.mood = nn.Parameter(
-            torch.from_numpy(mood).float().view(moodSize, self.moodLen).to(DEVICE),
-            requires_grad=True
-        )
+            # Gaussian smoothing along the frame axis, same spirit as the
+            # 129-tap savgol_filter this replaces, but deterministic under
+            # torch.manual_seed and with no NumPy round trip
+            kernel = torch.exp(-torch.linspace(-2., 2., 129, device=DEVICE) ** 2)
+            kernel /= kernel.sum()
+            mood = nn.functional.conv1d(
+                mood.t().unsqueeze(1), kernel.view(1, 1, -1), padding=64
+            ).squeeze(1).t()
+        self.mood = nn.Parameter(mood, requires_grad=True)
 
         self.articulation = nn.Sequential(
             nn.Conv2d(
@@ -224,48 +210,100 @@ class Model(nn.Module):
 
     def forward(self, inp, mood, moodIndex=0):
         out = self.formantAnalysis(inp)
-        if mood is not None:
-            out = torch.cat(
-                (
-                    out,
-                    mood.view(
-                        mood.view(-1, self.moodLen).size()[0], self.moodLen, 1, 1
-                    ).expand(out.size()[0], self.moodLen, 64, 1)
-                ),
-                dim=1
-            ).view(-1, 256 + self.moodLen, 64, 1)
-        else:
-            out = torch.cat(
-                (
-                    out,
-                    torch.cat((
-                        self.mood[moodIndex.chunk(chunks=1, dim=0)],
-                        self.mood[(moodIndex + 1).chunk(chunks=1, dim=0)]
-                    ), dim=0).view(
-                        out.size()[0], self.moodLen, 1, 1
-                    ).expand(out.size()[0], self.moodLen, 64, 1)
-                ),
-                dim=1
-            ).view(-1, 256 + self.moodLen, 64, 1)
-        out = self.articulation(out)
+        if mood is None:
+            mood = torch.cat(
+                (self.mood[moodIndex], self.mood[moodIndex + 1]), dim=0
+            )
+        # write both halves into one buffer instead of torch.cat, which
+        # would allocate another full (batch, 272, 64, 1) intermediate;
+        # channels_last so the articulation convs keep the conv layout
+        glue = torch.empty(
+            out.size()[0], 256 + self.moodLen, 64, 1,
+            device=out.device, dtype=out.dtype,
+            memory_format=torch.channels_last
+        )
+        glue[:, :256] = out
+        glue[:, 256:] = mood.view(-1, self.moodLen, 1, 1).expand(
+            out.size()[0], self.moodLen, 64, 1
+        )
+        out = self.articulation(glue)
         out = self.output(out.view(-1, 256 + self.moodLen))
         return out.view(-1, OUTPUT_COUNT)
 
 
+def collatePairs(batch):
+    # flatten the pair dim into the batch dim in the worker, so each step
+    # gets one contiguous pinnable buffer and no reshaping on the GPU path
+    return (
+        torch.tensor([sample[0] for sample in batch]),
+        torch.stack([sample[1] for sample in batch]).view(-1, 1, 64, 32),
+        torch.stack([sample[2] for sample in batch]).view(-1, OUTPUT_COUNT),
+    )
+
+
+def freezeForPreview(model, batchSize=1):
+    # fuses the Conv2d/BatchNorm2d pairs into plain convs for inference
+    model.eval()
+    exampleInput = torch.zeros(batchSize, 1, 64, 32, device=DEVICE)
+    exampleMood = model.mood[:1].expand(batchSize, model.moodLen)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, (exampleInput, exampleMood))
+        frozen = torch.jit.freeze(traced)
+        return torch.jit.optimize_for_inference(frozen)
+
+
+def preview(model, validationAudioPath, moodIndex=0, batchSize=256):
+    dataSet = Data(shiftRandom=False, validationAudioPath=validationAudioPath)
+    dataLoader = DataLoader(dataset=dataSet, batch_size=batchSize, shuffle=False)
+
+    wasTraining = model.training
+    inferenceModel = freezeForPreview(model, batchSize=batchSize)
+    results = []
+    with torch.inference_mode():
+        mood = model.mood[moodIndex].expand(batchSize, model.moodLen)
+        for _, inputData, _ in dataLoader:
+            inputData = inputData.to(DEVICE).contiguous(
+                memory_format=torch.channels_last
+            )
+            sampleCount = inputData.size()[0]
+            if sampleCount < batchSize:  # the trace baked in the batch size
+                inputData = nn.functional.pad(
+                    inputData, (0, 0, 0, 0, 0, 0, 0, batchSize - sampleCount)
+                )
+            results.append(inferenceModel(inputData, mood)[:sampleCount])
+    if wasTraining:
+        model.train()
+
+    # undo the .5 scaling applied to the training targets
+    return torch.cat(results) * 2.
+
+
 def train():
     batchSize = 1024
     dataSet = Data()
+    # short clips (~900 pairs for 30s of audio) would otherwise leave
+    # drop_last with zero full batches and the inner loop would never run
+    batchSize = min(batchSize, len(dataSet))
     dataLoader = DataLoader(
         dataset=dataSet,
         batch_size=batchSize,
         shuffle=True,
-        num_workers=8
+        num_workers=8,
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=2,
+        collate_fn=collatePairs,
+        drop_last=True  # keep batch shapes static for CUDA graph replay
     )
 
     model = Model(dataSet.count).to(DEVICE)
+    model = model.to(memory_format=torch.channels_last)
+    # static shapes, so reduce-overhead can capture the step as a CUDA graph
+    compiledModel = torch.compile(model, mode='reduce-overhead')
     modelOptimizer = torch.optim.Adam(
         model.parameters(),
-        lr=1e-3
+        lr=1e-3,
+        fused=True
     )
 
     epochCount = 50000
@@ -277,47 +315,42 @@ def train():
     if not os.path.exists(modelDir):
         os.makedirs(modelDir)
 
-    MSENoReductionCriterion = torch.nn.MSELoss(reduction='none').to(DEVICE)
+    gradScaler = torch.cuda.amp.GradScaler()
     for epochIdx in range(epochCount):
         for i, inputData, target in dataLoader:
-            i = i.to(DEVICE)
-            inputData = inputData.to(DEVICE)
-            target = target.to(DEVICE)
-            # compensate for paired input
-            inputData = inputData.view(-1, 1, 64, 32)
-            target = target.view(-1, OUTPUT_COUNT)
+            i = i.to(DEVICE, non_blocking=True)
+            inputData = inputData.to(DEVICE, non_blocking=True)
+            target = target.to(DEVICE, non_blocking=True)
+            inputData = inputData.contiguous(memory_format=torch.channels_last)
             targetPairView = target.view(-1, 2, OUTPUT_COUNT)
 
-            modelOptimizer.zero_grad()
-            modelResult = model(inputData, None, i)
-            modelResultPairView = modelResult.view(-1, 2, OUTPUT_COUNT)
+            modelOptimizer.zero_grad(set_to_none=True)
+            with torch.cuda.amp.autocast():
+                modelResult = compiledModel(inputData, None, i)
+                modelResultPairView = modelResult.view(-1, 2, OUTPUT_COUNT)
 
-            shapeLoss = torch.mean(torch.sum(
-                MSENoReductionCriterion(
+                # sum over features then mean over batch == sum over all / batch
+                shapeLoss = nn.functional.mse_loss(
                     modelResultPairView[:, 0, :],
-                    targetPairView[:, 0, :]
-                ),
-                dim=-1
-            ))
+                    targetPairView[:, 0, :],
+                    reduction='sum'
+                ) / i.size(0)
 
-            motionLoss = torch.mean(torch.sum(
-                MSENoReductionCriterion(
+                motionLoss = nn.functional.mse_loss(
                     modelResultPairView[:, 1, :] - modelResultPairView[:, 0, :],
                     targetPairView[:, 1, :] - targetPairView[:, 0, :],
-                ),
-                dim=-1
-            ))
+                    reduction='sum'
+                ) / i.size(0)
 
-            emotionLoss = torch.mean(torch.sum(
-                MSENoReductionCriterion(
+                emotionLoss = nn.functional.mse_loss(
+                    model.mood[i + 1],
                     model.mood[i],
-                    model.mood[i + 1]
-                ),
-                dim=-1
-            ))
+                    reduction='sum'
+                ) / i.size(0)
 
-            (shapeLoss + motionLoss + emotionLoss).backward()
-            modelOptimizer.step()
+            gradScaler.scale(shapeLoss + motionLoss + emotionLoss).backward()
+            gradScaler.step(modelOptimizer)
+            gradScaler.update()
 
         logWriter.add_scalar('emotion', emotionLoss.item(), epochIdx + 1)
         logWriter.add_scalar('motion', motionLoss.item(), epochIdx + 1)